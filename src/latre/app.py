@@ -2,7 +2,9 @@
 
 import os
 import sys
+import time
 import gettext
+import threading
 import concurrent.futures
 
 import gi
@@ -16,7 +18,7 @@ from gi.repository import GLib, Gtk, Gio, Gdk
 from . import config
 from . import data
 from .ui import COL_UID, COL_NAME
-from .model import abook, SEXP_ANY
+from .model import SEXP_ANY
 from .ui import LaTreUI, VCardFileChooser, RemovePromptDialog
 
 from . import model
@@ -45,6 +47,10 @@ class LaTreApp(Gtk.Application):
 		if not os.path.exists(config.userdata_dir):
 			os.mkdir(config.userdata_dir)
 		self.pending_imports = []
+		self.import_cancellable = None
+		self.remove_cancellable = None
+		self.export_cancellable = None
+		self.view = None
 
 
 	def set_ui(self):
@@ -60,6 +66,7 @@ class LaTreApp(Gtk.Application):
 		                          self.on_contact_tree_drag_data_received,
 		                          self.on_btn_ct_remove_clicked,
 		                          self.on_btn_ct_export_clicked,
+		                          self.on_btn_progress_cancel_clicked,
 		                          self.on_mainwindow_realize])
 		self.ui.filechooser = None
 		self.ui.set_accel_quit(self.quit)
@@ -78,7 +85,10 @@ class LaTreApp(Gtk.Application):
 
 	def on_mainwindow_realize(self, widget):
 		Gtk.main_iteration()
-		self.populate_contact_list()
+		# The window is shown while the address book is being opened
+		self.ui.btn_ct_add.set_sensitive(False)
+		self.ui.show_progress(_('Opening address book...'))
+		model.connect(self.on_book_connected)
 		self.ui.mainwindow.resize(550, 400)
 		# Set pane position
 		panewidth = self.ui.mainpane.get_allocated_width()
@@ -99,10 +109,7 @@ class LaTreApp(Gtk.Application):
 		self.ui.filechooser.hide()
 
 		try:
-			Gtk.main_iteration()
-			contacts = data.contacts_from_files(files)
-			model.contacts_to_edataserver_by_group(contacts, self.contacts_import_done)
-
+			self.import_files(files)
 		except UnboundLocalError: # files not defined
 			return
 
@@ -119,22 +126,97 @@ class LaTreApp(Gtk.Application):
 		if response != Gtk.ResponseType.ACCEPT:
 			return
 		uids = [model[p][COL_UID] for p in paths]
-		r = abook.remove_contacts_sync(uids, None)
-		if r:
-			iters = [model.get_iter(p) for p in paths]
-			[model.remove(i) for i in iters]
+		self.remove_contacts(uids)
+
+
+	def remove_contacts(self, uids):
+		''' Remove contacts from EDataServer, chunk by chunk, asynchronously.
+		Rows are removed from the list via the book view. '''
+		if self.remove_cancellable is not None:
+			# Another removal is running
+			return
+		self.remove_cancellable = Gio.Cancellable()
+		chunks = data.iter_batches(uids, config.remove_chunk_size)
+		self.remove_next_chunk(chunks, 0, len(uids))
+
+
+	def remove_next_chunk(self, chunks, done, total):
+		chunk = next(chunks, None)
+		if chunk is None or self.remove_cancellable.is_cancelled():
+			self.remove_finished()
+			return
+		self.ui.show_progress(_('Removed {} of {} contacts').format(done, total),
+		                      done / total)
+		model.abook.remove_contacts(chunk, self.remove_cancellable,
+		                            self.contacts_remove_done,
+		                            (chunks, done + len(chunk), total))
+
+
+	def contacts_remove_done(self, client, res, user_data):
+		try:
+			client.remove_contacts_finish(res)
+		except GLib.GError as e:
+			if not self.remove_cancellable.is_cancelled():
+				print(e, file=sys.stderr)
+			self.remove_finished()
+			return
+		self.remove_next_chunk(*user_data)
+
+
+	def remove_finished(self):
+		self.remove_cancellable = None
+		self.hide_progress_if_idle()
+
+
+	def on_book_connected(self, client, error):
+		self.ui.hide_progress()
+		if error:
+			print(error, file=sys.stderr)
+			return
+		self.populate_contact_list()
 
 
 	def populate_contact_list(self):
+		''' Fill the contact list from a book view, which also keeps it
+		up to date with changes, made by us or other applications. '''
 		self.ui.btn_ct_add.set_sensitive(False)
-		abook.get_contacts(SEXP_ANY, None, self.load_contacts_done, None)
+		model.abook.get_view(SEXP_ANY, None, self.get_view_done, None)
 
 
-	def load_contacts_done(self, source, res, user_data):
-		r, contacts = source.get_contacts_finish(res)
-		if r:
-			[self.ui.add_contact_to_treeview(c) for c in contacts]
+	def get_view_done(self, source, res, user_data):
+		try:
+			r, self.view = source.get_view_finish(res)
+		except GLib.GError as e:
+			print(e, file=sys.stderr)
+			r = False
+		if not r:
+			self.ui.btn_ct_add.set_sensitive(True)
+			return
+		self.view.connect('objects-added', self.on_view_objects_changed)
+		self.view.connect('objects-modified', self.on_view_objects_changed)
+		self.view.connect('objects-removed', self.on_view_objects_removed)
+		self.view.connect('complete', self.on_view_complete)
+		# Existing contacts come first, all at once. Keep the list
+		# detached from the view until then, to update the view only once.
+		self.ui.contact_tree.set_model(None)
+		self.view.start()
+
+
+	def on_view_objects_changed(self, view, contacts):
+		for c in contacts:
+			self.ui.add_contact_to_treeview(c)
+
+
+	def on_view_objects_removed(self, view, uids):
+		self.ui.remove_contacts_from_treeview(uids)
+
+
+	def on_view_complete(self, view, error):
+		if self.ui.contact_tree.get_model() is None:
+			self.ui.contact_tree.set_model(self.ui.contactfilter)
 		self.ui.btn_ct_add.set_sensitive(True)
+		# Drop cached thumbnails of contacts removed since last run
+		self.ui.thumbnails.prune(self.ui.rows)
 		#self.ui.contact_tree.connect('size-allocate', self.on_contact_tree_size_allocate)
 		# For a short time later, the 'size-allocate' will be emitted, but
 		# we don't want the autoscroll is active right
@@ -146,7 +228,7 @@ class LaTreApp(Gtk.Application):
 		# trigger size-allocate, make the tree view scroll to end undesiredly.
 		# So we'll ignore the first trigger of this signal
 		if self._autoscroll_allow < AUTOSCROLL_THRESHOLD:
-			# AUTOSCROLL_THRESHOLD = 2, count the comment in load_contacts_done()
+			# AUTOSCROLL_THRESHOLD = 2, count the comment in on_view_complete()
 			self._autoscroll_allow += 1
 			return
 		selection = widget.get_selection()
@@ -167,33 +249,46 @@ class LaTreApp(Gtk.Application):
 		model, (path,) = selection.get_selected_rows()
 		uid = model[path][COL_UID]
 		self.ui.show_contact(uid)
+		self.ui.prefetch_contacts(model, path)
 
 
 	# Drag n Drop
 	def on_contact_tree_drag_data_received(self, widget, drag_context, x, y, sel_data, info, time):
 		uris = sel_data.get_uris()
-		Gtk.main_iteration()
-		contacts = data.contacts_from_files(uris)
-		model.contacts_to_edataserver_by_group(contacts, self.contacts_import_done)
+		self.import_files(uris)
 
 
 	def on_btn_ct_clear_clicked(self, widget):
+		if model.abook is None:
+			# Address book is not opened yet
+			return
 		dialog = RemovePromptDialog(_('all contacts'))
 		response = dialog.run()
 		dialog.destroy()
 		if response != Gtk.ResponseType.ACCEPT:
 			return
-		r, uids = abook.get_contacts_uids_sync(SEXP_ANY, None)
-		if not r:
+		self.ui.show_progress(_('Removing contacts...'))
+		model.abook.get_contacts_uids(SEXP_ANY, None, self.get_all_uids_done, None)
+
+
+	def get_all_uids_done(self, client, res, user_data):
+		try:
+			r, uids = client.get_contacts_uids_finish(res)
+		except GLib.GError as e:
+			print(e, file=sys.stderr)
+			r = False
+		if not r or not uids:
+			self.hide_progress_if_idle()
 			return
-		r = abook.remove_contacts_sync(uids, None)
-		if r:
-			self.ui.contactlist.clear()
+		self.remove_contacts(uids)
 
 
 	def on_btn_ct_export_clicked(self, widget):
 		# If no contact is chosen, we export all.
 		# Otherwise, export selected contacts
+		if model.abook is None or self.export_cancellable is not None:
+			# Address book is not opened yet, or another export is running
+			return
 		selection = self.ui.contact_selection
 		dialog = VCardFileChooser(self.ui.mainwindow,
 		                          Gtk.FileChooserAction.SELECT_FOLDER)
@@ -207,73 +302,203 @@ class LaTreApp(Gtk.Application):
 			if not filename:
 				print('No file set', file=sys.stderr)
 				return
-			if not filename.endswith('.vcf'):
-				filename = filename + '.vcf'
+			filename = data.export_filename(filename, dialog.compression)
 		# Get options
 		options = {
 			'vcard_version': dialog.vcard_version,
 			'to_compose_unicode': dialog.to_compose_unicode,
-			'to_strip_unicode': dialog.to_strip_unicode
+			'to_strip_unicode': dialog.to_strip_unicode,
+			'photos': dialog.photos,
+			'compression': dialog.compression
 		}
 		dialog.destroy()
 		if resp != Gtk.ResponseType.OK:
 			return
 		Gtk.main_iteration()
 		liststore, paths = selection.get_selected_rows()
-		if paths:
-			uids = (liststore[p][COL_UID] for p in paths)
-		else:
-			uids = None
-
-		# Chose to save as separated files
+		uids = [liststore[p][COL_UID] for p in paths] or None
+		# Chose to save as separated files, or to common file
 		if action == Gtk.FileChooserAction.SELECT_FOLDER:
-			if uids:
-				vcards_iter = model.export_vcards_by_uids(uids, options, True)
-			else:
-				vcards_iter = model.export_vcards_all(options, True)
-			for vc, name in vcards_iter:
-				if not name:
-					continue
-				filename = os.path.join(folder, name + '.vcf')
-				data.vcard_to_file(vc, filename)
-		# Chose to save to common file.
+			target, separated = folder, True
 		else:
+			target, separated = filename, False
+		self.export_cancellable = cancellable = Gio.Cancellable()
+		self.ui.show_progress(_('Exporting...'))
+		thread = threading.Thread(target=self.export_worker,
+		                          args=(uids, options, target, separated, cancellable),
+		                          daemon=True)
+		thread.start()
+
+
+	def export_worker(self, uids, options, target, separated, cancellable):
+		''' Export contacts to a folder or a file, in background thread.
+		The UI is only touched via GLib.idle_add(). '''
+		# Kept if the export stops on an unexpected error
+		text = _('Export failed')
+		failures = []
+		try:
 			if uids:
-				vcards = model.export_vcards_by_uids(uids, options)
+				vcards = model.export_vcards_by_uids(uids, options, separated)
+			else:
+				vcards = model.export_vcards_all(options, separated)
+			vcards = stop_if_cancelled(vcards, cancellable)
+			if separated:
+				count, failures = data.vcards_to_folder(vcards, target,
+				                                        report=self.on_export_progress)
+				text = _('Exported {} files').format(count)
 			else:
-				vcards = model.export_vcards_all(options)
-			with open(filename, 'w') as fl:
-				fl.write('\n'.join(vcards))
+				data.vcards_to_file(vcards, target, options['compression'])
+				text = _('Exported to {}').format(os.path.basename(target))
+		except (GLib.GError, OSError) as e:
+			if cancellable.is_cancelled():
+				text = _('Export cancelled')
+			else:
+				print(e, file=sys.stderr)
+				failures = [(target, e)]
+		finally:
+			GLib.idle_add(self.export_finished, text, failures)
+
+
+	def on_export_progress(self, count, rate):
+		''' Called from export thread '''
+		GLib.idle_add(self.ui.show_progress,
+		              _('Exported {} files ({:.0f} files/s)').format(count, rate))
+
+
+	def export_finished(self, text, failures):
+		self.export_cancellable = None
+		self.ui.show_progress(text, 1)
+		if failures:
+			self.ui.show_errors(_('Some contacts could not be exported'),
+			                    ['{}: {}'.format(os.path.basename(f),
+			                                  getattr(e, 'strerror', None) or e)
+			                     for f, e in failures])
+		GLib.timeout_add_seconds(3, self.hide_progress_if_idle)
+		return False
+
+
+	def hide_progress_if_idle(self):
+		''' Hide progress bar, unless another task is still running '''
+		if not (self.import_cancellable or self.remove_cancellable
+		        or self.export_cancellable):
+			self.ui.hide_progress()
+		return False
+
+
+	def on_btn_progress_cancel_clicked(self, widget):
+		if self.import_cancellable:
+			self.import_cancellable.cancel()
+		if self.remove_cancellable:
+			self.remove_cancellable.cancel()
+		if self.export_cancellable:
+			self.export_cancellable.cancel()
+
+
+	def import_files(self, files):
+		''' Import contacts from vCard files, in background thread '''
+		if self.import_cancellable is not None or model.abook is None:
+			# Another import is running, or address book is not opened yet
+			return
+		self.import_cancellable = cancellable = Gio.Cancellable()
+		self.ui.btn_ct_add.set_sensitive(False)
+		self.ui.show_progress(_('Reading files...'))
+		thread = threading.Thread(target=self.import_worker,
+		                          args=(files, cancellable), daemon=True)
+		thread.start()
+
+
+	def import_worker(self, files, cancellable):
+		''' Run the import pipeline: read -> parse -> dedupe -> conflict check
+		-> add. The UI is only touched via GLib.idle_add(). '''
+		progress = ImportProgress()
+		stats = {}    # File -> counts of vCards and duplicates
+		try:
+			vcards = data.iter_unique_vcards(files, stats)
+			vcards = progress.track_reading(vcards, cancellable)
+			# Parsing runs ahead in another thread, but pauses when
+			# adding to EDataServer falls behind by some batches.
+			batches = data.prefetch(data.iter_contact_batches(vcards))
+			# Added contacts come to the list via the book view
+			for added, count in model.contacts_to_edataserver_by_batch(
+			                    batches, cancellable=cancellable):
+				progress.added(count, self.on_import_progress)
+		except GLib.GError as e:
+			if not cancellable.is_cancelled():
+				print(e, file=sys.stderr)
+		finally:
+			GLib.idle_add(self.import_finished, progress.summary(stats))
+
+
+	def on_import_progress(self, text, fraction=None):
+		''' Called from import thread '''
+		GLib.idle_add(self.ui.show_progress, text, fraction)
+
+
+	def import_finished(self, text):
+		self.import_cancellable = None
+		self.ui.show_progress(text, 1)
+		self.ui.btn_ct_add.set_sensitive(True)
+		GLib.timeout_add_seconds(3, self.hide_progress_if_idle)
+		return False
 
 
 	def quit(self):
-		abook.cancel_all()
+		if self.import_cancellable:
+			self.import_cancellable.cancel()
+		if self.remove_cancellable:
+			self.remove_cancellable.cancel()
+		if self.export_cancellable:
+			self.export_cancellable.cancel()
+		if model.abook:
+			model.abook.cancel_all()
 		super(LaTreApp, self).quit()
 
 
-	# Callback for the case of adding multiple contacts
-	def contacts_import_done(self, client, res, user_data):
-		try:
-			success, uids = client.add_contacts_finish(res)
-		except GLib.GError as e:
-			print(e, file=sys.stderr)
-			return
-		if not success:
-			return
-		cons = model.get_contacts_by_uids(uids)
-		for c in cons:
-			self.ui.add_contact_to_treeview(c)
-		self._autoscroll_allow = 0
+def stop_if_cancelled(items, cancellable):
+	''' Pass items through, raising GLib.GError when cancelled '''
+	for item in items:
+		cancellable.set_error_if_cancelled()
+		yield item
 
 
-	# Callback for the case of adding single contact
-	def contact_import_done(self, client, res, user_data):
-		success, uid = client.add_contact_finish(res)
-		if not success:
+class ImportProgress:
+	''' Count imported vCards and compose progress text '''
+	# Minimum interval (seconds) between two progress reports
+	interval = 0.2
+
+	def __init__(self):
+		self.start = self.last_report = time.perf_counter()
+		self.read = 0
+		self.processed = 0
+
+	def track_reading(self, vcards, cancellable):
+		''' Pass vCards through, counting them. Stop when cancelled. '''
+		for v in vcards:
+			if cancellable.is_cancelled():
+				return
+			self.read += 1
+			yield v
+
+	def added(self, count, report):
+		self.processed += count
+		now = time.perf_counter()
+		if now - self.last_report < self.interval:
 			return
-		r, con = client.get_contact_sync(uid, None)
-		if r:
-			self.ui.add_contact_to_treeview(con)
+		self.last_report = now
+		rate = self.processed / (now - self.start)
+		report(_('Read {} cards, processed {} ({:.0f} cards/s)').\
+		       format(self.read, self.processed, rate))
+
+	def summary(self, stats):
+		''' Final text, with numbers of duplicated vCards which are skipped.
+		stats is filled by data.iter_unique_vcards(). '''
+		# Reading may still go on in another thread, if cancelled
+		counts = list(stats.copy().values())
+		cards = sum(c['cards'] for c in counts)
+		same = sum(c['file_duplicates'] for c in counts)
+		other = sum(c['cross_duplicates'] for c in counts)
+		return _('Read {} cards, processed {}. Skipped {} duplicated in same file, '
+		         '{} in other files').format(cards, self.processed, same, other)
 
 
 if __name__ == '__main__':
@@ -10,3 +10,33 @@ userloc = os.path.expanduser('~')
 data_dir = os.path.join(parentloc, 'share', package)
 userdata_dir = os.path.join(userloc, '.local', 'share', package)
 dbfile = os.path.join(userdata_dir, package + '.db')
+thumbnail_dir = os.path.join(userdata_dir, 'thumbnails')
+# Number of threads creating contacts from vCards when importing.
+# None means number of CPUs.
+parse_workers = None
+# Number of processes to transform vCard text when exporting.
+# None means number of CPUs.
+transform_workers = None
+# Country calling code, like '84', to match national phone numbers, like
+# 0912345678, with international ones. None means national numbers are
+# only matched with each other.
+phone_country_code = None
+# Max number of phone numbers in one chunk of contacts to check for
+# conflicts and add to EDataServer
+conflict_query_chunk = 200
+# Number of vCards to parse and add to EDataServer at once, when importing
+import_batch_size = 1000
+# Number of parsed batches allowed to wait for being added to EDataServer
+import_queue_size = 2
+# Number of vCards sent to the transform pool at once, when exporting
+export_page_size = 200
+# Number of threads writing files, when exporting one file per contact
+export_workers = 4
+# Max size of photo data cached for exporting, in bytes
+photo_cache_bytes = 32 * 1024 * 1024
+# Max number of UIDs in one query to EDataServer, and number of queries run
+# at the same time
+uid_query_chunk = 100
+uid_query_workers = 4
+# Number of contacts removed from EDataServer at once
+remove_chunk_size = 500
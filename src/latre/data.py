@@ -1,14 +1,44 @@
 import os
 import os.path
 import shutil
-import re
+import time
+import io
+import gzip
+import codecs
+import zipfile
+import tempfile
+import contextlib
+import hashlib
+import threading
+import itertools
+import functools
+import collections
+import unicodedata
+import logging
+import queue
+import multiprocessing
 import urllib.parse
 import concurrent.futures
-from gi.repository import EBook
-from gi.repository.EBookContacts import Contact
+import unidecode
+from gi.repository.EBookContacts import Contact, VCard
 from . import config
 
 _data_dir = config.data_dir
+# The umask can only be read by setting it, which affects all threads.
+# Read it once, at import.
+_umask = os.umask(0)
+os.umask(_umask)
+
+# File extensions of exported file, by compression
+COMPRESSED_EXTENSIONS = {
+	None: '.vcf',
+	'gzip': '.vcf.gz',
+	'zip': '.zip'
+}
+# Properties whose values are binary data
+BINARY_PROPS = ('PHOTO', 'LOGO', 'SOUND', 'KEY')
+# Encodings to try, in order, when decoding vCard files
+FALLBACK_ENCODINGS = ('utf-8', 'cp1258')
 
 def run_from_source():
 	''' If running from source, return source folder path,
@@ -33,31 +63,301 @@ def uifile(name):
 def iconfile():
 	return os.path.join(_data_dir, config.package + '.svg')
 
-def contacts_from_files(files):
-	vcards = set()
-	with concurrent.futures.ThreadPoolExecutor(max_workers=5) as e:
-		fts = [e.submit(vcards_from_file, f) for f in files]
-	for f in concurrent.futures.as_completed(fts):
-		if f.exception() is None:
-			vcs = f.result()
-			vcards = vcards.union(vcs)
-	contacts = [Contact.new_from_vcard(v) for v in vcards]
-	return contacts
-
-def vcards_from_file(fil):
+def iter_unique_vcards(files, stats=None):
+	''' Yield vCards from files, skipping the ones having the same
+	canonical digest as a previous one. Only digests are kept in memory. '''
+	seen = {}   # Digest -> index of file where it is found first
+	if stats is None:
+		stats = {}
+	for i, fil in enumerate(files):
+		count = {'cards': 0, 'file_duplicates': 0, 'cross_duplicates': 0}
+		stats[fil] = count
+		try:
+			for vcard in iter_vcards_from_file(fil):
+				count['cards'] += 1
+				digest = vcard_digest(vcard)
+				first = seen.get(digest)
+				if first is None:
+					seen[digest] = i
+					yield vcard
+				elif first == i:
+					count['file_duplicates'] += 1
+				else:
+					count['cross_duplicates'] += 1
+		except OSError as e:
+			logging.error('Failed to read %s: %s', fil, e)
+		logging.info('%s: %d vCards, %d duplicated in same file, '
+		             '%d duplicated in other files', fil, count['cards'],
+		             count['file_duplicates'], count['cross_duplicates'])
+
+def contacts_from_vcards(vcards):
+	''' Create Contact objects from vCard strings. '''
+	return [Contact.new_from_vcard(v) for v in vcards]
+
+def iter_contact_batches(vcards, size=config.import_batch_size,
+                         workers=config.parse_workers):
+	''' Create Contact objects from vCard strings, yield them in lists
+	of given size. Each batch is split among a thread pool, as PyGObject
+	releases the GIL while libebook parses. '''
+	workers = workers or os.cpu_count() or 1
+	start = time.perf_counter()
+	count = 0
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as e:
+		for batch in iter_batches(vcards, size):
+			step = -(-len(batch) // workers)
+			parts = [batch[i:i+step] for i in range(0, len(batch), step)]
+			contacts = [c for part in e.map(contacts_from_vcards, parts) for c in part]
+			count += len(contacts)
+			yield contacts
+	elapsed = time.perf_counter() - start
+	logging.info('Parsed %d vCards with %d threads in %.3fs (%.0f cards/s)',
+	             count, workers, elapsed, count / elapsed if elapsed else 0)
+
+def iter_batches(iterable, size):
+	''' Split iterable to lists of given size '''
+	it = iter(iterable)
+	while True:
+		batch = list(itertools.islice(it, size))
+		if not batch:
+			return
+		yield batch
+
+def prefetch(iterable, maxsize=config.import_queue_size):
+	''' Iterate over iterable in a separate thread, staying at most maxsize
+	items ahead of the consumer. The producer pauses when the consumer
+	falls behind, and stops when the consumer stops iterating. '''
+	items = queue.Queue(maxsize)
+	stopped = threading.Event()
+	end = object()
+
+	def produce():
+		it = iter(iterable)
+		try:
+			for item in it:
+				if not put(item):
+					return
+		except Exception as e:
+			put(e)
+		finally:
+			# Let generator clean up, like shutting down its process pool
+			if hasattr(it, 'close'):
+				it.close()
+		put(end)
+
+	def put(item):
+		while not stopped.is_set():
+			try:
+				items.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	threading.Thread(target=produce, daemon=True).start()
+	try:
+		while True:
+			item = items.get()
+			if item is end:
+				return
+			if isinstance(item, Exception):
+				raise item
+			yield item
+	finally:
+		stopped.set()
+
+def unfold_vcard(vcard):
+	''' Yield logical lines of vCard, joining folded lines and
+	quoted-printable soft line breaks. '''
+	logical = None
+	for line in vcard.splitlines():
+		if logical is None:
+			logical = line
+		elif line[:1] in (' ', '\t'):
+			logical += line[1:]
+		elif logical.endswith('=') and 'QUOTED-PRINTABLE' in logical.upper():
+			logical = logical[:-1] + line
+		else:
+			yield logical
+			logical = line
+	if logical is not None:
+		yield logical
+
+def transform_vcard_text(vcard, compose=False, strip=False):
+	''' Compose Unicode (NFC) and/or strip it to ASCII, in the text
+	properties of vCard. Binary payloads, like photos, are kept as they are. '''
+	lines = []
+	binary = False
+	for line in vcard.splitlines(True):
+		if line[:1] not in (' ', '\t'):
+			# New property, not a folded line
+			name = line.partition(':')[0].split(';', 1)[0].rsplit('.', 1)[-1]
+			binary = name.upper() in BINARY_PROPS
+		if not binary and not line.isascii():
+			if compose:
+				line = unicodedata.normalize('NFC', line)
+			if strip:
+				line = unidecode.unidecode(line)
+		lines.append(line)
+	return ''.join(lines)
+
+def transform_vcards(items, compose=False, strip=False,
+                     workers=config.transform_workers, size=config.export_page_size):
+	''' Apply transform_vcard_text() to (vcard, name) items, on a process pool.
+	The order of items is kept. '''
+	transform = functools.partial(transform_vcard_item, compose=compose, strip=strip)
+	return pool_map(transform, items, size, workers)
+
+def transform_vcard_item(item, compose=False, strip=False):
+	vcard, name = item
+	return transform_vcard_text(vcard, compose, strip), name
+
+def pool_map(func, items, size, workers=config.transform_workers):
+	''' Apply func to items on a process pool, yielding the results in order.
+	Items are sent in batches of given size. The pool is only started when
+	there is a full batch, small input is not worth it. '''
+	executor = None
+	try:
+		for batch in iter_batches(items, size):
+			if workers == 1 or (executor is None and len(batch) < size):
+				yield from map(func, batch)
+				continue
+			if executor is None:
+				# Forking this multithreaded GTK/D-Bus process is not safe
+				context = multiprocessing.get_context('forkserver')
+				executor = concurrent.futures.ProcessPoolExecutor(workers,
+				                                                  mp_context=context)
+			chunksize = max(1, len(batch) // ((workers or os.cpu_count() or 1) * 4))
+			yield from executor.map(func, batch, chunksize=chunksize)
+	finally:
+		if executor is not None:
+			executor.shutdown()
+
+def vcard_digest(vcard):
+	''' Digest of vCard which does not change with line endings, folding,
+	order of properties or trailing whitespaces. '''
+	lines = sorted(filter(None, (l.rstrip() for l in unfold_vcard(vcard))))
+	return hashlib.sha1('\n'.join(lines).encode()).digest()
+
+def iter_vcards_from_file(fil):
+	''' Yield vCard blocks from file, one at a time.
+	The file is scanned line by line, so only one vCard is held in memory. '''
 	if fil.startswith('file://'): # fil is a URI
 		fil = fil[7:]             # Strip "file://" part
 		fil = urllib.parse.unquote(fil)
 	elif '://' in fil:            # Other URI schemes (http, ftp...) are rejected
 		return
-	with open(fil) as fl:
-		content = fl.read()
-	# There may be multiple vcards in file
-	# Use set to avoid duplicated
-	vcards = set()
-	for m in re.finditer('BEGIN:VCARD.+?END:VCARD', content, re.DOTALL):
-		vcards.add(m.group(0))
-	return vcards
+	with open(fil, 'rb') as fl:
+		yield from iter_vcards(fl)
+
+def iter_vcards(lines):
+	''' Group raw lines (bytes) into vCard strings.
+	Line endings are normalized to CRLF. Folded lines (starting with
+	space or tab) and quoted-printable soft line breaks are kept as they are,
+	but never taken as BEGIN/END marker. '''
+	block = None
+	continued = False   # Previous line ended with QP soft line break
+	for line in lines:
+		line = line.rstrip(b'\r\n')
+		if not continued and line[:1] not in (b' ', b'\t'):
+			marker = line.strip().lstrip(codecs.BOM_UTF8).upper()
+			if marker == b'BEGIN:VCARD':
+				block = [b'BEGIN:VCARD']
+				continue
+			if marker == b'END:VCARD' and block is not None:
+				block.append(b'END:VCARD')
+				yield decode_vcard(b'\r\n'.join(block))
+				block = None
+				continue
+		if block is not None:
+			block.append(line)
+		# Quoted-printable value continues on next line if ending with '='
+		if line.endswith(b'='):
+			continued = continued or b'QUOTED-PRINTABLE' in line.upper()
+		else:
+			continued = False
+
+def decode_vcard(raw):
+	''' Decode vCard bytes, falling back to legacy encodings. '''
+	for enc in FALLBACK_ENCODINGS:
+		try:
+			return raw.decode(enc)
+		except UnicodeDecodeError:
+			continue
+	return raw.decode('latin-1')
+
+def vcards_to_folder(vcards, folder, workers=config.export_workers, report=None):
+	''' Write each vCard to its own file in folder, named after contact.
+	vcards is an iterable of (vcard, name). The files are written by a thread
+	pool. report(count, rate) is called from time to time with the number
+	of written files and files/s. Return the number of written files and
+	the list of (filename, error) for the failed ones. '''
+	names = FilenameAllocator(folder)
+	start = last_report = time.perf_counter()
+	count = 0
+	failures = []
+	pending = {}    # Future -> file name
+
+	def collect(done):
+		written = 0
+		for f in done:
+			filename = pending.pop(f)
+			error = f.exception()
+			if error is None:
+				written += 1
+			else:
+				logging.error('Failed to write %s: %s', filename, error)
+				failures.append((filename, error))
+		return written
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as e:
+		for vcard, name in vcards:
+			if not name:
+				continue
+			filename = names.allocate(name.replace(os.sep, '_') + '.vcf')
+			pending[e.submit(write_file, vcard, filename)] = filename
+			# Do not let unwritten vCards pile up in memory
+			if len(pending) < workers * 4:
+				continue
+			done, not_done = concurrent.futures.wait(pending,
+			                    return_when=concurrent.futures.FIRST_COMPLETED)
+			count += collect(done)
+			now = time.perf_counter()
+			if report and now - last_report >= 0.2:
+				last_report = now
+				report(count, count / (now - start))
+		done, not_done = concurrent.futures.wait(pending)
+		count += collect(done)
+	if report:
+		elapsed = time.perf_counter() - start
+		report(count, count / elapsed if elapsed else 0)
+	return count, failures
+
+def write_file(content, filename):
+	with open(filename, 'w') as fl:
+		fl.write(content)
+
+
+class FilenameAllocator:
+	''' Give unique file names in a folder. The folder is listed only once,
+	then the taken names are tracked in memory. '''
+	def __init__(self, folder):
+		self.folder = folder
+		self.taken = set(os.listdir(folder))
+		self.next_suffix = {}   # File name -> next number to try as suffix
+
+	def allocate(self, filename):
+		''' Return a path for filename, with number suffix if needed, like
+		"John (0).vcf" '''
+		if filename in self.taken:
+			name, ext = os.path.splitext(filename)
+			i = self.next_suffix.get(filename, 0)
+			while '{} ({}){}'.format(name, i, ext) in self.taken:
+				i += 1
+			self.next_suffix[filename] = i + 1
+			filename = '{} ({}){}'.format(name, i, ext)
+		self.taken.add(filename)
+		return os.path.join(self.folder, filename)
+
 
 def filename_with_numsuffix(filename):
 	i = -1
@@ -73,12 +373,110 @@ def vcard_to_file(vcard, filename):
 	with open(filename, 'w') as fl:
 		fl.write(vcard)
 
+def vcards_to_file(vcards, filename, compression=None):
+	''' Write vCards to one file, each one as soon as it is produced.
+	Compression can be None, 'gzip' or 'zip'. The content goes to a temporary
+	file first, which replaces the target file only when all is written. '''
+	folder, basename = os.path.split(filename)
+	fd, tmpname = tempfile.mkstemp(prefix='.' + basename, dir=folder or '.')
+	try:
+		# mkstemp() creates file only readable by owner
+		os.fchmod(fd, 0o666 & ~_umask)
+		with os.fdopen(fd, 'wb') as raw, \
+		     open_compressed(raw, basename, compression) as stream, \
+		     io.TextIOWrapper(stream, encoding='utf-8', newline='') as fl:
+			for i, vcard in enumerate(vcards):
+				if i:
+					fl.write('\n')
+				fl.write(vcard)
+		os.replace(tmpname, filename)
+	except BaseException:
+		os.unlink(tmpname)
+		raise
+
+def export_filename(filename, compression=None):
+	''' Give filename the extension for compression, replacing the vCard
+	or compressed file extension it has already, if any. '''
+	for ext in sorted(set(COMPRESSED_EXTENSIONS.values()), key=len, reverse=True):
+		if filename.lower().endswith(ext):
+			filename = filename[:-len(ext)]
+			break
+	return filename + COMPRESSED_EXTENSIONS[compression]
+
+@contextlib.contextmanager
+def open_compressed(raw, basename, compression):
+	''' Wrap binary file object with compressor '''
+	name = basename
+	for ext in COMPRESSED_EXTENSIONS.values():
+		if ext != '.vcf' and name.endswith(ext):
+			name = name[:-len(ext)] + '.vcf'
+	if compression == 'gzip':
+		with gzip.GzipFile(name, 'wb', fileobj=raw) as stream:
+			yield stream
+	elif compression == 'zip':
+		with zipfile.ZipFile(raw, 'w', zipfile.ZIP_DEFLATED) as zf, \
+		     zf.open(name, 'w') as stream:
+			yield stream
+	else:
+		yield raw
+
+def contact_fields(contact, skipped=('UID', 'REV')):
+	''' Get attributes of contact, grouped by vCard field name.
+	Return a dict of field name -> Counter of normalized attributes,
+	so that the order of attributes does not matter. '''
+	fields = {}
+	# Contact.get_attributes() is for a single field, use the VCard's one
+	for attr in VCard.get_attributes(contact):
+		name = attr.get_name().upper()
+		if name in skipped:
+			continue
+		params = frozenset((p.get_name().upper(), tuple(sorted(p.get_values())))
+		                   for p in attr.get_params())
+		values = tuple(v.strip() for v in attr.get_values())
+		fields.setdefault(name, collections.Counter())[(values, params)] += 1
+	return fields
+
+def contact_fingerprint(contact):
+	''' Digest of contact content, with UID and REV left out.
+	It is cached on the contact, so do not modify the contact afterward. '''
+	fingerprint = getattr(contact, 'fingerprint', None)
+	if fingerprint is None:
+		lines = []
+		for name, attrs in contact_fields(contact).items():
+			for (values, params), count in attrs.items():
+				line = name + ''.join(';{}={}'.format(p, ','.join(v))
+				                      for p, v in sorted(params))
+				line += ':' + ';'.join(values)
+				lines.extend([line] * count)
+		lines.sort()
+		fingerprint = hashlib.sha1('\n'.join(lines).encode()).digest()
+		contact.fingerprint = fingerprint
+	return fingerprint
+
 def contacts_identical(contact1, contact2):
-	cformat = getattr(EBook.VCardFormat, '30')
-	return (contact1.to_string(cformat) == contact2.to_string(cformat))
+	return contact_fingerprint(contact1) == contact_fingerprint(contact2)
 
 def contact_already_in_list(contact, contactlist):
-	for c in contactlist:
-		if contacts_identical(contact, c):
-			return True
-	return False
+	''' Check if contact is in list. For many checks against the same list,
+	pass a ContactSet instead of list. '''
+	if isinstance(contactlist, ContactSet):
+		return contact in contactlist
+	fingerprint = contact_fingerprint(contact)
+	return any(contact_fingerprint(c) == fingerprint for c in contactlist)
+
+
+class ContactSet:
+	''' Set of contacts, compared by content '''
+	def __init__(self, contacts=()):
+		self._fingerprints = set()
+		for c in contacts:
+			self.add(c)
+
+	def add(self, contact):
+		self._fingerprints.add(contact_fingerprint(contact))
+
+	def __contains__(self, contact):
+		return contact_fingerprint(contact) in self._fingerprints
+
+	def __len__(self):
+		return len(self._fingerprints)
@@ -1,19 +1,26 @@
 #! /usr/bin/env python3
 
+import os
 import re
-import difflib
 import logging
+import threading
 import datetime
-import unicodedata
+import collections
+import concurrent.futures
+import urllib.parse
 import dateutil.parser
 
 import unidecode
 from gi.repository import EBook
 from gi.repository import EDataServer
-from gi.repository.EBookContacts import Contact, ContactField, BookQuery, \
-                                        BookQueryTest, VCardFormat
+from gi.repository import GLib
+from gi.repository import Gio
+from gi.repository import GdkPixbuf
+from gi.repository.EBookContacts import Contact, ContactField, ContactPhoto, \
+                                        BookQuery, BookQueryTest, VCardFormat
 
 from . import config
+from . import data
 
 logging.basicConfig(filename='/tmp/latre.log', filemode='w', level=logging.DEBUG)
 
@@ -31,12 +38,57 @@ PHONE_PROPS = (
 	'car-phone',
 	'pager'
 )
+# Max width/height of photos exported as small
+SIZE_PHOTO_SMALL = 96
 SEXP_ANY = BookQuery.any_field_contains('').to_string()
 
-registry = EDataServer.SourceRegistry.new_sync(None)
-source = registry.ref_builtin_address_book()
-abook = EBook.BookClient.new(source)
-abook.open_sync(False, None)
+# The address book client. It is opened asynchronously by connect(),
+# or given by set_client(), e.g. a local stand-in.
+registry = None
+abook = None
+
+def connect(callback, cancellable=None):
+	''' Open the built-in address book without blocking, then call
+	callback(client, error) in the main loop. If a client is set already,
+	it is passed to the callback right away. '''
+	if abook is not None:
+		callback(abook, None)
+		return
+	EDataServer.SourceRegistry.new(cancellable, _on_registry_ready,
+	                               (callback, cancellable))
+
+
+def _on_registry_ready(source_object, res, user_data):
+	global registry
+	callback, cancellable = user_data
+	try:
+		registry = EDataServer.SourceRegistry.new_finish(res)
+		client = EBook.BookClient.new(registry.ref_builtin_address_book())
+	except GLib.GError as e:
+		callback(None, e)
+		return
+	client.open(False, cancellable, _on_client_opened, user_data)
+
+
+def _on_client_opened(client, res, user_data):
+	callback, cancellable = user_data
+	try:
+		client.open_finish(res)
+	except GLib.GError as e:
+		callback(None, e)
+		return
+	set_client(client)
+	callback(client, None)
+
+
+def set_client(client):
+	''' Use given client for all address book operations '''
+	global abook, _phone_index
+	with _phone_index_lock:
+		abook = client
+		# The index belongs to the old client
+		_phone_index = None
+
 
 def get_first_phone(contact):
 	for p in PHONE_PROPS:
@@ -53,7 +105,30 @@ def get_repr_name(contact):
 		return get_first_phone(contact) or contact.get_property('email-1')
 
 
-def get_contacts_by_uids(uids):
+# Runs UID queries concurrently, shared by all callers
+_uid_query_executor = concurrent.futures.ThreadPoolExecutor(
+                          max_workers=config.uid_query_workers)
+
+def get_contacts_by_uids(uids, chunk_size=config.uid_query_chunk):
+	''' Get contacts of given UIDs, in the same order. They are fetched
+	from EDataServer in chunks, which are queried concurrently. '''
+	uids = list(uids)
+	chunks = [uids[i:i+chunk_size] for i in range(0, len(uids), chunk_size)]
+	if len(chunks) <= 1:
+		results = map(query_contacts_by_uids, chunks)
+	else:
+		results = _uid_query_executor.map(query_contacts_by_uids, chunks)
+	return [c for chunk, cons in zip(chunks, results)
+	        for c in in_uid_order(chunk, cons)]
+
+
+def in_uid_order(uids, contacts):
+	''' Sort contacts to the order of their UIDs '''
+	found = dict((c.get_property('id'), c) for c in contacts)
+	return [found[u] for u in uids if u in found]
+
+
+def query_contacts_by_uids(uids):
 	# Build query
 	queries = []
 	for i in uids:
@@ -66,21 +141,130 @@ def get_contacts_by_uids(uids):
 	return []
 
 
-def get_contacts_all():
-	r, cons = abook.get_contacts_sync(SEXP_ANY, None)
-	if r:
-		return cons
-	return []
+def iter_contacts_all(chunk_size=config.uid_query_chunk,
+                      ahead=config.uid_query_workers):
+	''' Yield all contacts, fetching them from EDataServer chunk by chunk,
+	to not load the whole address book into memory. Some chunks are
+	queried ahead, concurrently. '''
+	r, uids = abook.get_contacts_uids_sync(SEXP_ANY, None)
+	if not r:
+		return
+	pending = collections.deque()
+	for i in range(0, len(uids), chunk_size):
+		chunk = uids[i:i+chunk_size]
+		pending.append((chunk, _uid_query_executor.submit(query_contacts_by_uids, chunk)))
+		if len(pending) >= ahead:
+			chunk, future = pending.popleft()
+			yield from in_uid_order(chunk, future.result())
+	for chunk, future in pending:
+		yield from in_uid_order(chunk, future.result())
+
+
+class PhotoCache:
+	''' LRU cache of photo data, limited by total size in bytes '''
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.size = 0
+		self._items = collections.OrderedDict()
+
+	def get(self, key):
+		try:
+			self._items.move_to_end(key)
+		except KeyError:
+			return None
+		return self._items[key]
+
+	def put(self, key, value):
+		''' value is (data, mime type) '''
+		if key in self._items:
+			self.size -= len(self._items.pop(key)[0])
+		if len(value[0]) > self.max_bytes:
+			return
+		self._items[key] = value
+		self.size += len(value[0])
+		while self.size > self.max_bytes:
+			k, (data, mime) = self._items.popitem(last=False)
+			self.size -= len(data)
+
+
+photo_cache = PhotoCache(config.photo_cache_bytes)
+
+
+def inline_photo(contact, mode='keep'):
+	''' Replace photo given as local file with its inlined data, so that
+	it is included in exported vCard. Mode can be:
+	 - 'keep': Keep photo as it is.
+	 - 'skip': Remove photo.
+	 - 'small': Downscale photo to SIZE_PHOTO_SMALL. '''
+	photo = contact.get_property('photo')
+	if not photo:
+		return
+	if mode == 'skip':
+		contact.set_property('photo', None)
+		return
+	uri = photo.get_uri()
+	if uri:
+		path = urllib.parse.unquote(urllib.parse.urlparse(uri).path)
+		try:
+			st = os.stat(path)
+		except OSError as e:
+			logging.warning('Cannot read photo %s: %s', path, e)
+			return
+		key = (uri, st.st_mtime_ns, st.st_size, mode)
+		cached = photo_cache.get(key)
+		if cached is None:
+			with open(path, 'rb') as fl:
+				photodata = fl.read()
+			cached = (photodata, photo_mime_type(path, photodata))
+			if mode == 'small':
+				cached = downscale_photo(*cached)
+			photo_cache.put(key, cached)
+	elif mode == 'small':
+		cached = downscale_photo(bytes(photo.get_inlined()), photo.get_mime_type())
+	else:
+		return
+	data, mime = cached
+	newphoto = ContactPhoto.new()
+	newphoto.set_inlined(data)
+	newphoto.set_mime_type(mime)
+	contact.set_property('photo', newphoto)
+
+
+def photo_mime_type(path, data):
+	''' Guess MIME type of photo from its content. The file name does
+	not tell, EDataServer names the files like "photo.image%2Fpng". '''
+	content_type, uncertain = Gio.content_type_guess(path, data)
+	return Gio.content_type_get_mime_type(content_type) or 'image/jpeg'
+
+
+def downscale_photo(data, mime=None):
+	''' Scale image down to SIZE_PHOTO_SMALL, return (data, mime type) '''
+	loader = GdkPixbuf.PixbufLoader()
+	try:
+		loader.write(data)
+		loader.close()
+	except GLib.GError as e:
+		logging.warning('Cannot load photo: %s', e)
+		return data, mime
+	pixbuf = loader.get_pixbuf()
+	width, height = pixbuf.get_width(), pixbuf.get_height()
+	scale = SIZE_PHOTO_SMALL / max(width, height)
+	if scale < 1:
+		pixbuf = pixbuf.scale_simple(max(1, round(width*scale)),
+		                             max(1, round(height*scale)),
+		                             GdkPixbuf.InterpType.BILINEAR)
+	r, small = pixbuf.save_to_bufferv('jpeg', ['quality'], ['85'])
+	return small, 'image/jpeg'
 
 
 def contact_to_vcard_string(contact, options={}, return_name=False):
-	contact.inline_local_photos()
+	inline_photo(contact, options.get('photos', 'keep'))
 	version = options.get('vcard_version', '21')
 	vcard = contact.to_string(getattr(VCardFormat, version))
-	if options.get('to_compose_unicode'):
-		vcard = unicodedata.normalize('NFC', vcard)
-	if options.get('to_strip_unicode'):
-		vcard = unidecode.unidecode(vcard)
+	compose = options.get('to_compose_unicode')
+	strip = options.get('to_strip_unicode')
+	if compose or strip:
+		vcard = data.transform_vcard_text(vcard, compose, strip)
 	if return_name:
 		name = get_repr_name(contact)
 		return vcard, name
@@ -89,13 +273,24 @@ def contact_to_vcard_string(contact, options={}, return_name=False):
 
 
 def export_vcards_all(options={}, return_name=False):
-	for c in get_contacts_all():
-		yield contact_to_vcard_string(c, options, return_name)
+	return export_contacts(iter_contacts_all(), options, return_name)
 
 
 def export_vcards_by_uids(uids, options={}, return_name=False):
-	for c in get_contacts_by_uids(uids):
-		yield contact_to_vcard_string(c, options, return_name)
+	return export_contacts(get_contacts_by_uids(uids), options, return_name)
+
+
+def export_contacts(contacts, options={}, return_name=False):
+	''' Serialize contacts to vCard strings. The Unicode transforms, if any,
+	are done on a process pool. '''
+	compose = options.get('to_compose_unicode')
+	strip = options.get('to_strip_unicode')
+	serialize_options = dict(options, to_compose_unicode=False, to_strip_unicode=False)
+	items = (contact_to_vcard_string(c, serialize_options, True) for c in contacts)
+	if compose or strip:
+		items = data.transform_vcards(items, compose, strip)
+	for vcard, name in items:
+		yield (vcard, name) if return_name else vcard
 
 
 def contacts_to_edataserver_one_by_one(contacts, callback):
@@ -112,124 +307,414 @@ def contacts_to_edataserver_one_by_one(contacts, callback):
 			try_solve_conflicts(c, conflicts)
 
 
-def contacts_to_edataserver_by_group(contacts, callback):
-	''' Add a group of contacts to EDataServer.
-	Note that the callback here is for the case of adding
-	multiple contacts. '''
-	contacts = reduce_to_uniques(contacts)
-	# First, we test with all numbers here for any one existing already in EDataServer
-	numbers = []
+def contacts_to_edataserver_by_batch(batches, chunk_size=config.conflict_query_chunk,
+                                     cancellable=None):
+	''' Add batches of contacts to EDataServer, synchronously.
+	Contacts duplicated across batches are melded with the ones added before
+	by REV, like duplicates in one batch, so the result does not depend on
+	how the contacts are split. Yield the list of added contacts and
+	the number of contacts processed, for each chunk. '''
+	imported = {}   # UID -> REV of contacts added by this import
+	for batch in batches:
+		for chunk in chunk_by_numbers(reduce_to_uniques(batch), chunk_size):
+			if cancellable and cancellable.is_cancelled():
+				return
+			added = add_chunk_to_edataserver(chunk, cancellable=cancellable,
+			                                 imported=imported)
+			yield added, len(chunk)
+
+
+def chunk_by_numbers(contacts, size):
+	''' Split contacts to lists having no more than "size" phone numbers
+	in total (unless a single contact has more). '''
+	chunk = []
+	count = 0
 	for c in contacts:
-		numbers.extend(c.numbers)
-	query = make_query_test_any_number_exist(numbers)
-	r, conflicts = abook.get_contacts_sync(query, None)
-	if not conflicts:
+		if chunk and count + len(c.numbers) > size:
+			yield chunk
+			chunk = []
+			count = 0
+		chunk.append(c)
+		count += len(c.numbers)
+	if chunk:
+		yield chunk
+
+
+def add_chunk_to_edataserver(chunk, cancellable=None, imported=None):
+	''' Add a chunk of contacts synchronously, solving conflicts with
+	existing ones. Return the list of added contacts. If imported is a dict,
+	the revision_sort_key() of added contacts are recorded in it by UID
+	(see try_solve_conflicts()). '''
+	numbers = [n for c in chunk for n in c.numbers]
+	index = get_phone_index()
+	uids = index.lookup(numbers)
+	if not uids:
 		# No conflict, add in batch
-		abook.add_contacts(contacts, None, callback, None)
-		return
-	# else: One of contacts in group has conflict with database
-	for c in contacts:
-		narrow_conflicts = narrow_conflicts_around_contact(conflicts, c)
-		if not narrow_conflicts:
-			# No conflict
-			abook.add_contacts((c,), None, callback, None)
-		else:
-			try_solve_conflicts(c, narrow_conflicts)
+		free = chunk
+	else:
+		# Only the conflicting contacts need to be fetched
+		conflicts = get_contacts_by_uids(uids)
+		free = []
+		for c in chunk:
+			narrow_conflicts = narrow_conflicts_around_contact(conflicts, c)
+			if narrow_conflicts:
+				try_solve_conflicts(c, narrow_conflicts, imported)
+			else:
+				free.append(c)
+	if not free:
+		return []
+	r, uids = abook.add_contacts_sync(free, cancellable)
+	if not r:
+		return []
+	for c, uid in zip(free, uids):
+		c.set_property('id', uid)
+		index.add(c)
+		if imported is not None:
+			imported[c.get_property('id')] = revision_sort_key(c)
+	return free
 
 
 def reduce_to_uniques(contacts):
 	''' Combines contacts which share 1 or more phone numbers.
 	Return list of separated contacts '''
 	for c in contacts:
-		ats = c.get_attributes(ContactField.TEL)
-		c.numbers = frozenset(a.get_value() for a in ats)
-
-	if len(contacts) == 1:
-		return contacts
-	# More than 1
-	uniques = []
-	while len(contacts) > 1:
-		reduced = []
-		picked = contacts[0]
-		for c in contacts[1:]:
-			if len(picked.numbers & c.numbers):
-				picked = meld_to_newer(picked, c)
-			else:
-				reduced.append(c)
-		contacts = reduced
-		uniques.append(picked)
-	# Add the last remain
-	uniques.append(contacts[0])
-	return uniques
-
-
-def make_query_test_any_number_exist(numbers):
-	queries = []
-	for n in numbers:
-		q = BookQuery.vcard_field_test('TEL', BookQueryTest.CONTAINS, n)
-		queries.append(q.to_string())
-	return "(or {})".format(' '.join(queries))
+		if getattr(c, 'numbers', None) is None:
+			ats = c.get_attributes(ContactField.TEL)
+			c.numbers = frozenset(a.get_value() for a in ats)
+
+	if len(contacts) <= 1:
+		return list(contacts)
+	# Group contacts with union-find, joined by the numbers they share
+	parents = list(range(len(contacts)))
+
+	def find(i):
+		while parents[i] != i:
+			parents[i] = parents[parents[i]]
+			i = parents[i]
+		return i
+
+	owners = {}   # Phone key -> index of first contact having it
+	for i, c in enumerate(contacts):
+		for k in phone_keys(c.numbers):
+			j = owners.setdefault(k, i)
+			ri, rj = find(i), find(j)
+			if ri != rj:
+				# Keep the earlier contact as root, to preserve order
+				parents[max(ri, rj)] = min(ri, rj)
+	groups = {}
+	for i, c in enumerate(contacts):
+		groups.setdefault(find(i), []).append(c)
+	return [meld_to_newer(*g) if len(g) > 1 else g[0] for g in groups.values()]
 
 
 def get_conflicts_of_contact(contact):
 	''' Search among existing contacts for the one having
 	1 same phone number as the given contact. '''
-	# Build query
 	ats = contact.get_attributes(ContactField.TEL)
-	numbers = frozenset(a.get_value() for a in ats)
-	query = make_query_test_any_number_exist(numbers)
-	# Apply query
-	r, conflicts = abook.get_contacts_sync(query, None)
-	return conflicts
+	contact.numbers = frozenset(a.get_value() for a in ats)
+	uids = get_phone_index().lookup(contact.numbers)
+	if not uids:
+		return []
+	return narrow_conflicts_around_contact(get_contacts_by_uids(uids), contact)
 
 
 def narrow_conflicts_around_contact(conflicts, contact):
+	''' Pick the contacts sharing a phone number with the given one.
+	Their actual numbers are compared, not only the index. '''
+	keys = phone_keys(contact.numbers)
 	new = []
 	for c in conflicts:
 		ats = c.get_attributes(ContactField.TEL)
-		cf_numbers = frozenset(a.get_value() for a in ats)
-		if cf_numbers.intersection(contact.numbers):
+		if keys & phone_keys(a.get_value() for a in ats):
 			new.append(c)
 	return new
 
 
-def meld_to_newer(c1, c2):
-	rev1 = c1.get_property('Rev')
-	rev2 = c2.get_property('Rev')
-	if rev1 and rev2:
-		d1 = dateutil.parser.parse(rev1)
-		d2 = dateutil.parser.parse(rev2)
-	elif not rev2:
-		d1 = d2 = 0
-	else:
-		d2 = 1
-		d1 = 0
-	if d1 >= d2:
-		c = mix_phones(c1, c2)
-	else:
-		c = mix_phones(c2, c1)
+def phone_key(number, country_code=config.phone_country_code):
+	''' Canonical form of phone number, to find the same number written
+	differently, like "+84 912 345 678" and "0084912345678". If the country
+	code is set, national numbers with trunk prefix, like "0912345678",
+	are converted to international form too. The whole number is kept. '''
+	number = number.strip()
+	digits = re.sub(r'[^0-9]', '', number)
+	if not digits:
+		return ''
+	if number.startswith('+'):
+		return '+' + digits
+	if digits.startswith('00'):
+		# International call prefix
+		return '+' + digits[2:]
+	if country_code and digits.startswith('0'):
+		# Trunk prefix
+		return '+' + country_code + digits[1:]
+	return digits
+
+
+def phone_keys(numbers):
+	return frozenset(filter(None, map(phone_key, numbers)))
+
+
+class PhoneIndex:
+	''' Map phone numbers (in canonical form) to UIDs of contacts
+	in address book, to look for conflicts without querying EDataServer. '''
+	def __init__(self, contacts=()):
+		self._uids = {}    # Phone key -> set of UIDs
+		self._keys = {}    # UID -> phone keys
+		# Import runs in another thread than the one receiving view signals
+		self._lock = threading.Lock()
+		for c in contacts:
+			self.add(c)
+
+	def add(self, contact):
+		uid = contact.get_property('id')
+		ats = contact.get_attributes(ContactField.TEL)
+		keys = phone_keys(a.get_value() for a in ats)
+		with self._lock:
+			self._remove(uid)
+			self._keys[uid] = keys
+			for k in keys:
+				self._uids.setdefault(k, set()).add(uid)
+
+	def remove(self, uid):
+		with self._lock:
+			self._remove(uid)
+
+	def _remove(self, uid):
+		for k in self._keys.pop(uid, ()):
+			uids = self._uids[k]
+			uids.discard(uid)
+			if not uids:
+				del self._uids[k]
+
+	def lookup(self, numbers):
+		''' Return UIDs of contacts having any of given numbers '''
+		found = set()
+		with self._lock:
+			for n in numbers:
+				found.update(self._uids.get(phone_key(n), ()))
+		found.discard(None)
+		return found
+
+	def watch(self, client):
+		''' Keep up to date with changes in address book '''
+		r, self._view = client.get_view_sync(SEXP_ANY, None)
+		if not r:
+			return
+		# Existing contacts are indexed already
+		self._view.set_flags(EBook.BookClientViewFlags.NONE)
+		self._view.connect('objects-added', self.on_objects_changed)
+		self._view.connect('objects-modified', self.on_objects_changed)
+		self._view.connect('objects-removed', self.on_objects_removed)
+		self._view.start()
+
+	def on_objects_changed(self, view, contacts):
+		for c in contacts:
+			self.add(c)
+
+	def on_objects_removed(self, view, uids):
+		for uid in uids:
+			self.remove(uid)
+
+
+def fold_text(text):
+	''' Fold text to lowercase ASCII, to match without diacritics '''
+	return unidecode.unidecode(text).lower()
+
+
+class SearchIndex:
+	''' In-memory index to search contacts by name or phone number.
+	Names are folded by fold_text(), numbers are kept as digits only.
+	Every word is indexed by its trigrams. Query words match anywhere in
+	the words, the ones shorter than 3 letters are looked for by scanning
+	all texts. '''
+	def __init__(self):
+		self._texts = {}   # UID -> searchable text
+		self._keys = {}    # Trigram or word prefix -> set of UIDs
+
+	def add(self, uid, name, numbers):
+		self.remove(uid)
+		words = [fold_text(name or '')]
+		words.extend(re.sub(r'[^0-9]', '', n) for n in numbers)
+		text = ' '.join(words)
+		self._texts[uid] = text
+		for k in self.text_keys(text):
+			self._keys.setdefault(k, set()).add(uid)
+
+	def remove(self, uid):
+		text = self._texts.pop(uid, None)
+		if text is None:
+			return
+		for k in self.text_keys(text):
+			uids = self._keys[k]
+			uids.discard(uid)
+			if not uids:
+				del self._keys[k]
+
+	def clear(self):
+		self._texts.clear()
+		self._keys.clear()
+
+	@staticmethod
+	def text_keys(text):
+		keys = set()
+		for w in text.split():
+			keys.update(w[i:i+3] for i in range(len(w) - 2))
+		return keys
+
+	@staticmethod
+	def query_words(query):
+		''' Fold query to words. Query of only number is taken as digits. '''
+		query = fold_text(query)
+		if not re.search('[a-z]', query):
+			query = re.sub(r'[^0-9]', '', query)
+		return query.split()
+
+	def search(self, query):
+		''' Return set of UIDs of contacts matching query, or None if
+		query is empty '''
+		words = self.query_words(query)
+		if not words:
+			return None
+		keys = set()
+		for w in words:
+			keys.update(w[i:i+3] for i in range(len(w) - 2))
+		if not keys:
+			# Only short words, which are not indexed
+			texts = self._texts
+			uids = texts.keys()
+			for w in words:
+				uids = [u for u in uids if w in texts[u]]
+			return set(uids)
+		# Intersect from the smallest set
+		sets = sorted((self._keys.get(k, ()) for k in keys), key=len)
+		if not sets[0]:
+			return set()
+		candidates = set(sets[0]).intersection(*sets[1:])
+		return set(u for u in candidates if self.match(u, words))
+
+	def match(self, uid, words):
+		text = self._texts.get(uid, '')
+		return all(w in text for w in words)
+
+
+_phone_index = None
+_phone_index_lock = threading.Lock()
+
+def get_phone_index():
+	''' Get the phone number index of address book, build it if needed.
+	Can be called from any thread, the view signals are still delivered
+	in the main loop. '''
+	global _phone_index
+	with _phone_index_lock:
+		if _phone_index is None:
+			_phone_index = PhoneIndex(iter_contacts_all())
+			_phone_index.watch(abook)
+	return _phone_index
+
+
+def get_revision(contact):
+	''' Get the REV of contact as datetime, or None '''
+	# Parsed REV is cached on the contact
+	rev = getattr(contact, 'revision', None)
+	if rev is not None:
+		return rev
+	rev = contact.get_property('Rev')
+	if not rev:
+		return None
+	try:
+		contact.revision = dateutil.parser.parse(rev)
+	except (ValueError, OverflowError):
+		logging.info('Invalid REV %s', rev)
+		return None
+	return contact.revision
+
+
+def revision_sort_key(contact):
+	''' Key to sort contacts by REV. Contacts without REV come first. '''
+	rev = get_revision(contact)
+	if rev is None:
+		return (False, 0)
+	if rev.tzinfo is None:
+		rev = rev.replace(tzinfo=datetime.timezone.utc)
+	return (True, rev.timestamp())
+
+
+def meld_to_newer(*contacts, key=revision_sort_key):
+	''' Mix phone numbers of all given contacts into the newest one,
+	by the key of their REVs. Among contacts of same REV, the first one
+	is kept. '''
+	# Sorting with reverse=True is still stable
+	newest, *others = sorted(contacts, key=key, reverse=True)
+	c = newest
+	for other in others:
+		c = mix_phones(c, other)
 	# Update numbers set
 	ats = c.get_attributes(ContactField.TEL)
 	c.numbers = frozenset(a.get_value() for a in ats)
 	return c
 
 
-def try_solve_conflicts(newcontact, conflicts):
+def try_solve_conflicts(newcontact, conflicts, imported=None):
+	''' Solve conflicts of new contact with existing ones. The conflicts
+	which were added earlier in the same import, whose UIDs and sort keys
+	of original REVs are in imported, are melded with the new contact
+	by REV, as duplicates in one batch are (see reduce_to_uniques()). '''
+	earlier = [c for c in conflicts if c.get_property('id') in (imported or ())]
+	if earlier:
+		conflicts = [c for c in conflicts if c.get_property('id') not in imported]
+		newcontact = meld_with_imported(newcontact, earlier, imported,
+		                                keep=not conflicts)
+		if not conflicts:
+			return
 	# If there is only conflict contact, just solve it with the new one.
 	# If there are more, we solve between these contacts first, then solve
 	# the last remain with the new.
 	existing = conflicts[0]
 	for other_existing in conflicts[1:]:
 		abook.remove_contact_sync(other_existing, None)
+		get_phone_index().remove(other_existing.get_property('id'))
 		merge_contacts(existing, other_existing)
 	# Merge if differ
-	if get_different_fields(existing, newcontact):
-		merge_contacts(existing, newcontact)
+	dif_vcardfields = get_different_fields(existing, newcontact)
+	if dif_vcardfields:
+		merge_contacts(existing, newcontact, dif_vcardfields)
+
+
+def meld_with_imported(newcontact, earlier, imported, keep=True):
+	''' Meld new contact with contacts added earlier in the same import,
+	into the newest one by their original REVs. If keep is True, the result
+	replaces the first of earlier contacts in EDataServer, otherwise all
+	of them are removed. Return the melded contact. '''
+	index = get_phone_index()
+	# EDataServer sets its own REV when adding, so the sort keys of
+	# original REVs are used. Cards without REV stay the oldest.
+	contacts = earlier + [newcontact]
+	keys = [imported[c.get_property('id')] for c in earlier]
+	keys.append(revision_sort_key(newcontact))
+	order = dict(zip(map(id, contacts), keys))
+	uid = earlier[0].get_property('id')
+	melded = meld_to_newer(*contacts, key=lambda c: order[id(c)])
+	removed = earlier[1:] if keep else earlier
+	for c in removed:
+		other = c.get_property('id')
+		abook.remove_contact_sync(c, None)
+		index.remove(other)
+		del imported[other]
+	if keep:
+		melded.set_property('id', uid)
+		melded.fingerprint = None
+		abook.modify_contact_sync(melded, None)
+		index.add(melded)
+		imported[uid] = max(keys)
+	else:
+		melded.set_property('id', None)
+	return melded
 
 
-def merge_contacts(existing, pending):
+def merge_contacts(existing, pending, dif_vcardfields=None):
 	''' Update existing contact with detail from new one. '''
-	dif_vcardfields = get_different_fields(existing, pending)
+	if dif_vcardfields is None:
+		dif_vcardfields = get_different_fields(existing, pending)
 	for vcfield in dif_vcardfields:
 		if vcfield == 'TEL':
 			# Mix phone numbers from pending contact to existing contact
@@ -243,25 +728,17 @@ def merge_contacts(existing, pending):
 				continue
 			new_attrs = pending.get_attributes(field)
 			existing.set_attributes(field, new_attrs)
+	existing.fingerprint = None
 	abook.modify_contact_sync(existing, None)
+	get_phone_index().add(existing)
 
 
 def get_different_fields(existing, pending):
 	''' At which field two contacts differ? '''
-	c1 = existing.to_string(getattr(VCardFormat, '30'))
-	c2 = pending.to_string(getattr(VCardFormat, '30'))
-	diffields = set()
-	for line in difflib.unified_diff(c1.splitlines(), c2.splitlines()):
-		if len(line) < 3:
-			continue
-		leading = line[:3]
-		if leading in ('+++', '---', '@@ '):
-			continue
-		if line[0] in ('-', '+') and line[1:4] not in ('UID', 'REV'):
-			m = re.search('([A-Z][-A-Z0-9]+)[:;]', line)
-			if m:
-				diffields.add(m.group(1))
-	return diffields
+	fields1 = data.contact_fields(existing)
+	fields2 = data.contact_fields(pending)
+	return set(f for f in fields1.keys() | fields2.keys()
+	           if fields1.get(f) != fields2.get(f))
 
 
 def mix_phones(existing, pending):
@@ -274,4 +751,6 @@ def mix_phones(existing, pending):
 	# Add these new phone numbers to existing contact
 	newtels.extend(tel1)
 	existing.set_attributes(ContactField.TEL, newtels)
+	# Content changed, drop the cached data.contact_fingerprint()
+	existing.fingerprint = None
 	return existing
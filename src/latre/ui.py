@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 
+import os
+import sys
 import math
+import time
+import hashlib
+import collections
+import concurrent.futures
 import urllib.parse
 import gettext
 
+import cairo
 from gi.repository import Gtk
 from gi.repository import GLib
 from gi.repository import Gdk
@@ -12,19 +19,40 @@ from gi.repository import EBook
 from gi.repository.GLib import GError
 from gi.repository.EBookContacts import Contact, ContactField
 
+from . import config
 from . import data
 from . import model
-from .model import abook, PHONE_PROPS
+from .model import PHONE_PROPS
 
 COL_NAME    = 0
 COL_DEFNUM  = 1
 COL_PHOTO   = 2
 COL_UID     = 3
+COL_VISIBLE = 4
 
 SIZE_PHOTO_LIST = 40
+RADIUS_PHOTO = 4
+# Number of decoded photos kept for the contact list
+THUMBNAIL_CACHE_SIZE = 500
+# PNG text option of cached thumbnail, to identify its photo
+THUMBNAIL_STAMP_OPTION = 'tEXt::latre-photo'
+# Number of contacts kept for the detail pane
+DETAIL_CACHE_SIZE = 100
+# Number of rows above and below the selected one, whose contacts are
+# fetched in advance
+DETAIL_PREFETCH_DISTANCE = 2
+# Number of removed or changed rows from which the list is detached from
+# its view while being updated
+BULK_UPDATE_ROWS = 100
 
 _ = gettext.gettext
 
+# Phone properties with their display names, looked up once
+PHONE_NAMES = tuple((p, Contact.pretty_name(Contact.field_id(p.replace('-', '_'))))
+                    for p in PHONE_PROPS)
+PHONE_NAME_MOBILE = Contact.pretty_name(ContactField.PHONE_MOBILE)
+PHONE_NAME_OTHER = Contact.pretty_name(ContactField.PHONE_OTHER)
+
 class UIFactory():
 	''' Allow to retrieve GUI elements as object attributes '''
 	def __init__(self, uifile):
@@ -64,6 +92,18 @@ class VCardFileChooser:
 			         new_with_label_from_widget(opt_v2, _('Ver 3.0'))
 			self.opt_prec = Gtk.CheckButton.new_with_label(_('Compose Unicode'))
 			self.opt_strp = Gtk.CheckButton.new_with_label(_('Strip Unicode'))
+			self.opt_compress = Gtk.ComboBoxText()
+			self.opt_compress.append('', _('No compression'))
+			self.opt_compress.append('gzip', _('Gzip'))
+			self.opt_compress.append('zip', _('Zip'))
+			self.opt_compress.set_active_id('')
+			# Compression is only for "All to one file"
+			self.opt_compress.set_sensitive(False)
+			self.opt_photos = Gtk.ComboBoxText()
+			self.opt_photos.append('keep', _('Keep photos'))
+			self.opt_photos.append('small', _('Small photos'))
+			self.opt_photos.append('skip', _('No photos'))
+			self.opt_photos.set_active_id('keep')
 			opt_per.connect('toggled', self.switch_saving, True)
 			opt_bulk.connect('toggled', self.switch_saving, False)
 			grid.attach(opt_per, 0, 0, 1, 1)
@@ -73,6 +113,10 @@ class VCardFileChooser:
 			grid.attach_next_to(self.opt_prec, opt_v2, Gtk.PositionType.RIGHT, 1, 1)
 			grid.attach_next_to(self.opt_strp, self.opt_prec,
 								Gtk.PositionType.BOTTOM, 1, 1)
+			grid.attach_next_to(self.opt_compress, self.opt_prec,
+			                    Gtk.PositionType.RIGHT, 1, 1)
+			grid.attach_next_to(self.opt_photos, self.opt_compress,
+			                    Gtk.PositionType.BOTTOM, 1, 1)
 			grid.show_all()
 			self.dialog.set_extra_widget(grid)
 
@@ -98,6 +142,14 @@ class VCardFileChooser:
 	def to_strip_unicode(self):
 		return self.opt_strp.get_active()
 
+	@property
+	def photos(self):
+		return self.opt_photos.get_active_id()
+
+	@property
+	def compression(self):
+		return self.opt_compress.get_active_id() or None
+
 	def run(self):
 		return self.dialog.run()
 
@@ -133,6 +185,7 @@ class VCardFileChooser:
 			self.dialog.set_action(Gtk.FileChooserAction.SELECT_FOLDER)
 		else:
 			self.dialog.set_action(Gtk.FileChooserAction.SAVE)
+		self.opt_compress.set_sensitive(not separating)
 
 
 class LaTreUI(UIFactory):
@@ -140,14 +193,42 @@ class LaTreUI(UIFactory):
 		f = data.uifile('MainWindow')
 		super().__init__(f)
 		self.make_photos_rounded()
+		icontheme = Gtk.IconTheme.get_default()
+		self.avatar_default = icontheme.load_icon('avatar-default', SIZE_PHOTO_LIST,
+		                                          Gtk.IconLookupFlags.USE_BUILTIN)
+		self.thumbnails = ThumbnailLoader(SIZE_PHOTO_LIST, self.contact_tree.queue_draw)
+		self.details = DetailCache(self.contactphoto.get_pixel_size())
+		self.shown_uid = None    # Contact to be shown in detail pane
+		# Phone numbers in detail pane. Their rows are reused for next
+		# contacts, not rebuilt.
+		self.phonebox = Gtk.Box.new(Gtk.Orientation.VERTICAL, 5)
+		self.phonebox.show()
+		self.phonerows = []    # (row, name label, value label)
+		self.contactdetail.pack_start(self.phonebox, True, True, 0)
+		# UID -> row in contactlist. ListStore iters stay valid until
+		# their rows are removed.
+		self.rows = {}
+		# Search is done on an in-memory index, whose result is applied
+		# to the list through a filter, on the COL_VISIBLE column.
+		self.search_index = model.SearchIndex()
+		self.search_words = None
+		self.search_matches = None    # None means no search
+		self.contactfilter = self.contactlist.filter_new()
+		self.contactfilter.set_visible_column(COL_VISIBLE)
+		self.contact_tree.set_model(self.contactfilter)
+		# Photos in list are not stored in the ListStore but looked up when
+		# the rows are drawn.
+		self.photo.clear_attributes(self.cell_photo)
+		self.photo.set_cell_data_func(self.cell_photo, self.render_photo_cell)
 		self._pending_handlers.extend([self.on_contact_tree_key_press_event,
+		                               self.on_search_entry_search_changed,
 		                               self.on_contact_tree_unselect_all,
 		                               self.on_contact_selection_changed])
 
 	def make_photos_rounded(self):
 		self.contactphoto._todraw = True  # Prevent the callback below from acting second time.
 		self.contactphoto.connect('draw', self.round_contact_photo)
-		# TODO: Rounded corner for photos in list.
+		# Photos in list are rounded by ThumbnailLoader
 
 	def round_contact_photo(self, widget, cairo_ctx, user_data=None):
 		# Prevent drawing being done second time.
@@ -155,7 +236,7 @@ class LaTreUI(UIFactory):
 		if not widget._todraw:
 			return
 		size = widget.get_pixel_size()
-		cairo_rounded_box(cairo_ctx, 0, 0, size, size, 4)
+		cairo_rounded_box(cairo_ctx, 0, 0, size, size, RADIUS_PHOTO)
 		cairo_ctx.clip()
 
 	def set_accel_quit(self, callback):
@@ -172,47 +253,166 @@ class LaTreUI(UIFactory):
 
 	def on_contact_selection_changed(self, selection):
 		if selection.count_selected_rows() == 0:
+			self.shown_uid = None
 			self.contactdetail.hide()
 
 	def on_contact_tree_unselect_all(self, treeview):
+		self.shown_uid = None
 		self.contactdetail.hide()
 
+	def show_progress(self, text, fraction=None):
+		''' Show progress of background task. The bar pulses if the fraction
+		is not known. '''
+		if fraction is None:
+			self.progressbar.pulse()
+		else:
+			self.progressbar.set_fraction(fraction)
+		self.progressbar.set_text(text)
+		self.progressbox.show()
+		return False
+
+	def hide_progress(self):
+		self.progressbox.hide()
+		return False
+
+	def show_errors(self, text, errors, limit=10):
+		''' Tell user about errors, listing the first ones '''
+		dialog = Gtk.MessageDialog(self.mainwindow, Gtk.DialogFlags.MODAL,
+		                           Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE, text)
+		details = errors[:limit]
+		if len(errors) > limit:
+			details.append(_('and {} more').format(len(errors) - limit))
+		dialog.format_secondary_text('\n'.join(details))
+		dialog.run()
+		dialog.destroy()
+
 	def add_contact_to_treeview(self, contact):
+		''' Add contact to list, or update its row if it is there already '''
 		try:
 			name = contact.get_property('name').to_string()
 		except AttributeError:
 			name = model.get_first_phone(contact) or contact.get_property('email-1')
 		number = model.get_first_phone(contact)
 		uid = contact.get_property('id')
-		photo = self.get_contact_photo(contact, SIZE_PHOTO_LIST)
-		if photo is None:
-			icontheme = Gtk.IconTheme.get_default()
-			photo = icontheme.load_icon('avatar-default', SIZE_PHOTO_LIST,
-			                            Gtk.IconLookupFlags.USE_BUILTIN)
-		self.contactlist.append((name, number, photo, uid))
+		# The photo is decoded later, only when the row is shown
+		self.thumbnails.set_source(contact)
+		numbers = [a.get_value() for a in contact.get_attributes(ContactField.TEL)]
+		self.search_index.add(uid, name, numbers)
+		visible = True
+		if self.search_matches is not None:
+			# Apply search to new or changed contact
+			visible = self.search_index.match(uid, self.search_words)
+			if visible:
+				self.search_matches.add(uid)
+			else:
+				self.search_matches.discard(uid)
+		itr = self.rows.get(uid)
+		if itr is None:
+			self.rows[uid] = self.contactlist.append((name, number, None, uid, visible))
+		else:
+			self.contactlist.set(itr, [COL_NAME, COL_DEFNUM, COL_VISIBLE],
+			                     [name, number, visible])
+		# Drop the outdated detail and show the new one, if it is being shown
+		if self.details.update(contact) and uid == self.shown_uid:
+			self.show_contact(uid)
 
 
-	def get_contact_photo(self, contact, size=SIZE_PHOTO_LIST):
-		photo = contact.get_property('photo')
-		if photo:
-			uri = photo.get_uri()
-			if uri:
-				path = urllib.parse.urlparse(uri).path
-				path = urllib.parse.unquote(path)
-				photo = GdkPixbuf.Pixbuf.new_from_file_at_size(path, size, size)
-			else:
-				inlined = photo.get_inlined()
-				photo = GdkPixbuf.Pixbuf.new_from_inline_at_size(inlined, size, size)
-		return photo
+	def remove_contacts_from_treeview(self, uids):
+		uids = [u for u in uids if u in self.rows]
+		if not uids:
+			return
+		if len(uids) == len(self.rows):
+			self.clear_treeview()
+			return
+		detach = self.detach_list(len(uids))
+		for uid in uids:
+			self.contactlist.remove(self.rows.pop(uid))
+			self.thumbnails.forget(uid)
+			self.details.discard(uid)
+			self.search_index.remove(uid)
+		if self.search_matches is not None:
+			self.search_matches.difference_update(uids)
+		if detach:
+			self.contact_tree.set_model(self.contactfilter)
+
+
+	def clear_treeview(self):
+		self.contactlist.clear()
+		self.rows.clear()
+		self.thumbnails.clear()
+		self.details.clear()
+		self.search_index.clear()
+		if self.search_matches is not None:
+			self.search_matches.clear()
+
+
+	def detach_list(self, count):
+		''' Detach the list from its view if many rows are to be changed,
+		to not update the view row by row. Return True if detached. '''
+		if count < BULK_UPDATE_ROWS or self.contact_tree.get_model() is None:
+			return False
+		self.contact_tree.set_model(None)
+		return True
+
+
+	def on_search_entry_search_changed(self, entry):
+		query = entry.get_text()
+		old = self.search_matches
+		self.search_words = self.search_index.query_words(query)
+		self.search_matches = new = self.search_index.search(query)
+		# Only the rows whose match changed are updated
+		if old is None and new is None:
+			return
+		elif old is None:
+			changed = self.rows.keys() - new
+		elif new is None:
+			changed = self.rows.keys() - old
+		else:
+			changed = old ^ new
+		detach = self.detach_list(len(changed))
+		for uid in changed:
+			self.contactlist.set_value(self.rows[uid], COL_VISIBLE,
+			                           new is None or uid in new)
+		if detach:
+			self.contact_tree.set_model(self.contactfilter)
+
+
+	def render_photo_cell(self, column, cell, liststore, itr, user_data=None):
+		uid = liststore.get_value(itr, COL_UID)
+		# The tree view also renders rows out of sight, to measure them.
+		# Only visible rows get their photos decoded.
+		photo = self.thumbnails.get(uid, self.is_row_visible(liststore, itr))
+		cell.set_property('pixbuf', photo or self.avatar_default)
+
+
+	def is_row_visible(self, treemodel, itr):
+		visible = self.contact_tree.get_visible_range()
+		if not visible:
+			return False
+		start, end = visible
+		path = treemodel.get_path(itr)
+		return start.compare(path) <= 0 <= end.compare(path)
 
 
 	def show_contact(self, uid):
-		Gtk.main_iteration()
-		try:
-			r, contact = abook.get_contact_sync(uid, None)
-		except GError:
-			return
-		if not r:
+		''' Show contact in detail pane. It is fetched from EDataServer in
+		background if not cached, so the list is not blocked. '''
+		self.shown_uid = uid
+		self.details.fetch(uid, self.show_contact_detail)
+
+
+	def prefetch_contacts(self, treemodel, path, distance=DETAIL_PREFETCH_DISTANCE):
+		''' Fetch contacts of rows around the path, for keyboard navigation '''
+		index = path.get_indices()[0]
+		count = len(treemodel)
+		for i in range(max(0, index - distance), min(count, index + distance + 1)):
+			if i != index:
+				self.details.fetch(treemodel[i][COL_UID])
+
+
+	def show_contact_detail(self, uid, contact, photo):
+		if uid != self.shown_uid:
+			# User has moved to other contact
 			return
 		#print(contact.to_string(getattr(EBook.VCardFormat, '30')))
 		# Name
@@ -223,29 +423,36 @@ class LaTreUI(UIFactory):
 		self.contactname.set_text(name)
 		# Photo
 		size = self.contactphoto.get_pixel_size()
-		photo = self.get_contact_photo(contact, size)
 		if photo:
 			self.contactphoto.set_from_pixbuf(photo)
 		else:
 			(self.contactphoto.get_icon_name() == ('avatar-default', size)) \
 			or self.contactphoto.set_from_icon_name('avatar-default', size)
-		# Get the children of contactdetail box
-		children = self.contactdetail.get_children()
-		# The 2nd child is for showing phone numbers.
-		if len(children) == 2:
-			# Remove phone numbers of old contact
-			self.contactdetail.remove(children[1])
 		# Show phone numbers of this new contact
-		grid = self.show_phonenumbers(contact)
-		self.contactdetail.pack_start(grid,
-		                              True, True, 0)
+		self.show_phonenumbers(contact)
 		self.contactdetail.set_visible(True)
-		grid.show_all()
-		self.contactdetail.show_all()
 
 
 	def show_phonenumbers(self, contact):
-		grid = Gtk.Box.new(Gtk.Orientation.VERTICAL, 5)
+		numbers = self.get_phonenumbers(contact)
+		# Create more rows if the pool is not enough
+		while len(self.phonerows) < len(numbers):
+			row = self.phonenumber_to_ui()
+			self.phonebox.pack_start(row[0], False, True, 0)
+			self.phonerows.append(row)
+		for i, (row, name_label, value_label) in enumerate(self.phonerows):
+			if i < len(numbers):
+				name, value = numbers[i]
+				name_label.set_text(name)
+				value_label.set_text(value)
+				row.show()
+			else:
+				row.hide()
+
+
+	def get_phonenumbers(self, contact):
+		''' Get list of (type name, number) of contact '''
+		numbers = []
 		# There is a bug in libebook that using Contact.get_poperty() does not
 		# retrieve all phone numbers. So we will apply a trick here.
 		all_numbers = set()    # All numbers found in vcard.
@@ -253,17 +460,12 @@ class LaTreUI(UIFactory):
 		all_numbers = set([t.get_value() for t in tels])
 
 		counted = set()      # Numbers get via Contact.get_poperty()
-		for p in PHONE_PROPS:
-			field = p.replace('-', '_')
-			fid = Contact.field_id(field)
+		for p, name in PHONE_NAMES:
 			value = contact.get_property(p)
 			if not value or value == '' or value in counted:
 				continue
 			counted.add(value)
-			name = Contact.pretty_name(fid)
-			# Add to UI
-			row = self.phonenumber_to_ui(name, value)
-			grid.pack_start(row, False, True, 0)
+			numbers.append((name, value))
 
 		# Check the remain numbers missed by get_property(). This part won't be needed
 		# when the libebook's bug is fixed.
@@ -271,26 +473,253 @@ class LaTreUI(UIFactory):
 		for attr in remains:
 			type_params = attr.get_param('TYPE')
 			if 'CELL' in type_params:
-				name = Contact.pretty_name(ContactField.PHONE_MOBILE)
+				name = PHONE_NAME_MOBILE
 			else:
-				name = Contact.pretty_name(ContactField.PHONE_OTHER)
-			value = attr.get_value()
-			row = self.phonenumber_to_ui(name, value)
-			grid.pack_start(row, False, True, 0)
+				name = PHONE_NAME_OTHER
+			numbers.append((name, attr.get_value()))
 
-		return grid
+		return numbers
 
 
-	def phonenumber_to_ui(self, name, value):
-		name = Gtk.Label(name)
-		value = Gtk.Label(value)
+	def phonenumber_to_ui(self):
+		''' Create a row to show phone number, to be filled later '''
+		name = Gtk.Label()
+		value = Gtk.Label()
 		value.set_selectable(True)
 		value.set_justify(Gtk.Justification.RIGHT)
 		value.set_alignment(1, 0.5)
 		row = Gtk.Box(Gtk.Orientation.HORIZONTAL)
 		row.pack_start(name, False, True, 0)
 		row.pack_start(value, True, True, 0)
-		return row
+		name.show()
+		value.show()
+		return row, name, value
+
+
+class ThumbnailLoader:
+	''' Decode contact photos in background threads, only when they are
+	asked for, and keep them in an LRU cache, keyed by UID and REV.
+	The scaled, rounded photos are also cached on disk, one file per
+	contact, to be reused in next run. '''
+	def __init__(self, size, on_ready, maxsize=THUMBNAIL_CACHE_SIZE,
+	             folder=config.thumbnail_dir):
+		self.size = size
+		self.folder = folder        # Where thumbnails are cached on disk
+		self.on_ready = on_ready    # Called when some photos are decoded
+		self.maxsize = maxsize
+		# UID -> (REV, photo file path). Inlined photos are not kept in
+		# memory, their path is None and they are fetched when decoded.
+		self.sources = {}
+		self.cache = collections.OrderedDict()   # (UID, REV) -> Pixbuf
+		self.pending = set()
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+	def set_source(self, contact):
+		uid = contact.get_property('id')
+		photo = contact.get_property('photo')
+		if not photo:
+			self.sources.pop(uid, None)
+		else:
+			self.sources[uid] = (contact.get_property('rev'), photo_path(photo))
+
+	def get(self, uid, decode=True):
+		''' Get photo if it is decoded, otherwise schedule it to be
+		decoded, if asked, and return None. '''
+		try:
+			rev, path = self.sources[uid]
+		except KeyError:
+			return None
+		key = (uid, rev)
+		try:
+			self.cache.move_to_end(key)
+			return self.cache[key]
+		except KeyError:
+			pass
+		if decode and key not in self.pending:
+			self.pending.add(key)
+			self.executor.submit(self.decode, key, path)
+
+	def decode(self, key, source):
+		''' Run in worker thread. The rounded thumbnail is read from disk cache
+		if it is there and made from the same photo, otherwise it is made from
+		the photo and saved. Inlined photo (source is None) is fetched from
+		EDataServer only if needed. '''
+		uid, rev = key
+		pixbuf = None
+		path = self.cached_path(uid)
+		try:
+			if source is None and rev:
+				# Inlined photo can only change with REV
+				stamp = 'rev:' + rev
+			else:
+				if source is None:
+					source = fetch_photo(uid)
+				stamp = photo_hash(source)
+			pixbuf = self.load_cached(path, stamp)
+			if pixbuf is None:
+				if source is None:
+					source = fetch_photo(uid)
+				pixbuf = rounded_pixbuf(load_photo(source, self.size), RADIUS_PHOTO)
+				self.save(pixbuf, path, stamp)
+		except (GLib.GError, OSError) as e:
+			print(e, file=sys.stderr)
+		GLib.idle_add(self.decoded, key, pixbuf)
+
+	def cached_path(self, uid):
+		''' Path of cached thumbnail, named after UID '''
+		uidhash = hashlib.sha1(uid.encode()).hexdigest()[:16]
+		return os.path.join(self.folder, uidhash + '.png')
+
+	def load_cached(self, path, stamp):
+		''' Load cached thumbnail if it is made from the photo of given stamp '''
+		try:
+			pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
+		except GLib.GError:
+			# Not cached yet
+			return None
+		if pixbuf.get_option(THUMBNAIL_STAMP_OPTION) == stamp:
+			return pixbuf
+
+	def save(self, pixbuf, path, stamp):
+		os.makedirs(self.folder, exist_ok=True)
+		tmp = path + '.tmp'
+		pixbuf.savev(tmp, 'png', [THUMBNAIL_STAMP_OPTION], [stamp])
+		os.replace(tmp, path)
+
+	def prune(self, uids):
+		''' Remove, in background, cached thumbnails of contacts
+		other than the given ones '''
+		self.executor.submit(self.remove_stale, list(uids), time.time())
+
+	def remove_stale(self, uids, since):
+		''' Run in worker thread. The thumbnails made after "since" are kept,
+		they may be of contacts added meanwhile. '''
+		keep = set(os.path.basename(self.cached_path(u)) for u in uids)
+		try:
+			entries = os.scandir(self.folder)
+		except OSError:
+			return
+		with entries:
+			for entry in entries:
+				if entry.name in keep:
+					continue
+				try:
+					if entry.stat().st_mtime < since:
+						os.unlink(entry.path)
+				except OSError:
+					pass
+
+	def forget(self, uid):
+		''' Forget removed contact, and its cached thumbnail '''
+		self.sources.pop(uid, None)
+		self.executor.submit(self.remove_cached, uid)
+
+	def remove_cached(self, uid):
+		try:
+			os.unlink(self.cached_path(uid))
+		except OSError:
+			pass
+
+	def clear(self):
+		self.sources.clear()
+		self.prune(())
+
+	def decoded(self, key, pixbuf):
+		self.pending.discard(key)
+		self.cache[key] = pixbuf
+		while len(self.cache) > self.maxsize:
+			self.cache.popitem(last=False)
+		self.on_ready()
+		return False
+
+
+class DetailCache:
+	''' Contacts for detail pane, fetched from EDataServer asynchronously,
+	with their decoded photos, kept in an LRU cache by UID. Cached contacts
+	are dropped when the book tells that they are changed (REV differs)
+	or removed. '''
+	def __init__(self, photo_size, maxsize=DETAIL_CACHE_SIZE):
+		self.photo_size = photo_size
+		self.maxsize = maxsize
+		self.cache = collections.OrderedDict()   # UID -> (REV, Contact, Pixbuf)
+		self.pending = {}    # UID -> callbacks waiting for the contact
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+	def fetch(self, uid, callback=None):
+		''' Get contact and its photo, then call callback(uid, contact, photo).
+		The callback is called right away if the contact is cached. '''
+		try:
+			self.cache.move_to_end(uid)
+			rev, contact, photo = self.cache[uid]
+		except KeyError:
+			pass
+		else:
+			if callback:
+				callback(uid, contact, photo)
+			return
+		callbacks = self.pending.get(uid)
+		if callbacks is not None:
+			# Being fetched
+			if callback:
+				callbacks.append(callback)
+			return
+		callbacks = self.pending[uid] = [callback] if callback else []
+		model.abook.get_contact(uid, None, self.on_contact_got, (uid, callbacks))
+
+	def on_contact_got(self, client, result, request):
+		uid, callbacks = request
+		try:
+			r, contact = client.get_contact_finish(result)
+		except GError as e:
+			print(e, file=sys.stderr)
+			r = False
+		if not r:
+			if self.pending.get(uid) is callbacks:
+				del self.pending[uid]
+			return
+		source = photo_source(contact)
+		if source is None:
+			self.store(uid, callbacks, contact, None)
+		else:
+			self.executor.submit(self.decode, uid, callbacks, contact, source)
+
+	def decode(self, uid, callbacks, contact, source):
+		''' Run in worker thread '''
+		try:
+			photo = load_photo(source, self.photo_size)
+		except GLib.GError as e:
+			print(e, file=sys.stderr)
+			photo = None
+		GLib.idle_add(self.store, uid, callbacks, contact, photo)
+
+	def store(self, uid, callbacks, contact, photo):
+		if self.pending.get(uid) is not callbacks:
+			# Contact is changed or removed while being fetched
+			return False
+		del self.pending[uid]
+		self.cache[uid] = (contact.get_property('rev'), contact, photo)
+		while len(self.cache) > self.maxsize:
+			self.cache.popitem(last=False)
+		for callback in callbacks:
+			callback(uid, contact, photo)
+		return False
+
+	def update(self, contact):
+		''' Drop cached contact if the given one is newer.
+		Return True if it was cached or being fetched. '''
+		uid = contact.get_property('id')
+		item = self.cache.get(uid)
+		if item is not None and item[0] == contact.get_property('rev'):
+			return False
+		return self.discard(uid)
+
+	def discard(self, uid):
+		dropped = self.cache.pop(uid, None) is not None
+		return (self.pending.pop(uid, None) is not None) or dropped
+
+	def clear(self):
+		self.cache.clear()
+		self.pending.clear()
 
 
 class RemovePromptDialog(Gtk.Dialog):
@@ -312,6 +741,72 @@ class RemovePromptDialog(Gtk.Dialog):
 
 ####  Functions  ####
 
+def photo_source(contact):
+	''' Get the file path or inlined data of contact photo '''
+	photo = contact.get_property('photo')
+	if not photo:
+		return None
+	return photo_path(photo) or bytes(photo.get_inlined())
+
+
+def photo_path(photo):
+	''' Get the file path of photo, or None if it is inlined '''
+	uri = photo.get_uri()
+	if uri:
+		path = urllib.parse.urlparse(uri).path
+		return urllib.parse.unquote(path)
+
+
+def fetch_photo(uid):
+	''' Get photo data of contact from EDataServer. Raise OSError if the
+	contact or its photo is gone. '''
+	try:
+		r, contact = model.abook.get_contact_sync(uid, None)
+	except GLib.GError as e:
+		raise OSError(e.message)
+	source = photo_source(contact) if r else None
+	if source is None:
+		raise OSError('No photo for {}'.format(uid))
+	return source
+
+
+def load_photo(source, size):
+	''' Load photo from file path or inlined data, scaled to fit size '''
+	if isinstance(source, str):
+		return GdkPixbuf.Pixbuf.new_from_file_at_size(source, size, size)
+	loader = GdkPixbuf.PixbufLoader()
+	loader.connect('size-prepared', scale_to_fit, size)
+	loader.write(source)
+	loader.close()
+	return loader.get_pixbuf()
+
+
+def photo_hash(source):
+	''' Hash to identify photo. For photo file, its path, modified time
+	and size are used, to not read the file. '''
+	if isinstance(source, str):
+		st = os.stat(source)
+		source = '{}:{}:{}'.format(source, st.st_mtime_ns, st.st_size).encode()
+	return hashlib.sha1(source).hexdigest()
+
+
+def rounded_pixbuf(pixbuf, radius):
+	''' Make a copy of pixbuf with rounded corners '''
+	width, height = pixbuf.get_width(), pixbuf.get_height()
+	surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+	cairo_ctx = cairo.Context(surface)
+	cairo_rounded_box(cairo_ctx, 0, 0, width, height, radius)
+	cairo_ctx.clip()
+	Gdk.cairo_set_source_pixbuf(cairo_ctx, pixbuf, 0, 0)
+	cairo_ctx.paint()
+	return Gdk.pixbuf_get_from_surface(surface, 0, 0, width, height)
+
+
+def scale_to_fit(loader, width, height, size):
+	scale = min(1, size / max(width, height, 1))
+	loader.set_size(max(1, round(width*scale)), max(1, round(height*scale)))
+
+
 def cairo_rounded_box(cairo_ctx, x, y, width, height, radius):
 	cairo_ctx.new_sub_path()
 	cairo_quater_arc(cairo_ctx, x+radius, y+radius, radius, 3)